@@ -1,12 +1,21 @@
-# streamlit_app.py — OpenFlow Data + Docs (no server-side filtering)
+# streamlit_app.py — OpenFlow Data + Docs (search filters applied by Cortex Search)
 import os
-import json
+import re
+import time
+import uuid
+import orjson
 import datetime as dt
+from collections import Counter
+import numpy as np
 import pandas as pd
+import requests
 import streamlit as st
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from snowflake.snowpark import Session
 from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSQLException
 from snowflake.connector.errors import ProgrammingError
 from cryptography.hazmat.primitives import serialization
 
@@ -14,9 +23,41 @@ from cryptography.hazmat.primitives import serialization
 st.set_page_config(page_title="OpenFlow Data + Docs", layout="wide")
 st.title("OpenFlow Data + Docs")
 
+@st.cache_resource(show_spinner=False)
+def get_session() -> Session:
+    """Existing Snowflake session (works only inside Snowflake), reused across reruns."""
+    return get_active_session()
+
+@st.cache_resource(show_spinner=False)
+def get_keypair_session(params: dict) -> Session:
+    """Key-pair authenticated session, created once per process and reused across reruns."""
+    # Load private key
+    with open(params["private_key_file"], "rb") as key_file:
+        p_key = serialization.load_pem_private_key(
+            key_file.read(),
+            password=params["private_key_passphrase"].encode()
+            if params["private_key_passphrase"] else None,
+        )
+    pkb = p_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+    connection = {
+        "account": params["account"],
+        "user": params["user"],
+        "role": params["role"],
+        "warehouse": params["warehouse"],
+        "database": params["database"],
+        "schema": params["schema"],
+        "private_key": pkb,
+    }
+    return Session.builder.configs(connection).create()
+
 # Try to use existing Snowflake session (works only inside Snowflake)
 try:
-    session = get_active_session()
+    session = get_session()
     st.success("Connected using Snowflake native session.")
 except Exception:
     st.warning("No active Snowflake session detected — creating one manually...")
@@ -33,31 +74,8 @@ except Exception:
         "private_key_passphrase": os.getenv("SNOWFLAKE_PRIVATE_KEY_PASSPHRASE", st.secrets.get("SNOWFLAKE_PRIVATE_KEY_PASSPHRASE", "")),
     }
 
-    # Load private key
     try:
-        with open(CONNECTION_PARAMETERS["private_key_file"], "rb") as key_file:
-            p_key = serialization.load_pem_private_key(
-                key_file.read(),
-                password=CONNECTION_PARAMETERS["private_key_passphrase"].encode()
-                if CONNECTION_PARAMETERS["private_key_passphrase"] else None,
-            )
-        pkb = p_key.private_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
-
-        connection = {
-            "account": CONNECTION_PARAMETERS["account"],
-            "user": CONNECTION_PARAMETERS["user"],
-            "role": CONNECTION_PARAMETERS["role"],
-            "warehouse": CONNECTION_PARAMETERS["warehouse"],
-            "database": CONNECTION_PARAMETERS["database"],
-            "schema": CONNECTION_PARAMETERS["schema"],
-            "private_key": pkb,
-        }
-
-        session = Session.builder.configs(connection).create()
+        session = get_keypair_session(CONNECTION_PARAMETERS)
         st.success("✅ Connected to Snowflake via key-pair authentication.")
     except FileNotFoundError:
         st.error("❌ Private key file not found. Make sure rsa_key.p8 is uploaded.")
@@ -72,12 +90,25 @@ SCHEMA = "RAW"
 SEARCH_SERVICE = "ANALYTICS_FA.RAW.DOCS_SEARCH_FA"   # Cortex Search service name
 DOCS_STAGE = "RAW_DOCS_STAGE"                        # stage for file preview
 PREVIEW_SECONDS = 3600                               # presigned URL validity
+PRESIGN_RETRY_SECONDS = 60                           # don't retry a failed presign sooner
 PREVIEW_LIMIT = 100                                  # row preview cap
+AGENT_NAME = "FA_DOCS_AGENT"                         # Cortex agent in DB.SCHEMA
+AGENT_REST_RETRY_SECONDS = 600                       # use the SQL agent this long after REST fails
 
 # ---------------------------- BASIC HELPERS ---------------------
 def sql_to_df(sql: str, params=None) -> pd.DataFrame:
     return session.sql(sql, params=params).to_pandas()
 
+def sql_to_df_streaming(sql: str, params=None) -> pd.DataFrame:
+    """Like sql_to_df, but fetched as Arrow batches. Peak memory is not lower:
+    the batches are concatenated into one frame at the end."""
+    sdf = session.sql(sql, params=params)
+    frames = list(sdf.to_pandas_batches())
+    if not frames:
+        # No batches means no columns either: take them from the schema
+        return pd.DataFrame(columns=sdf.schema.names)
+    return pd.concat(frames, ignore_index=True)
+
 def sql_scalar(sql: str, params=None):
     """Return the first column of the first row (or None)."""
     rows = session.sql(sql, params=params).collect()
@@ -92,98 +123,478 @@ def parse_variant_json(v):
         return {}
     if isinstance(v, str):
         try:
-            return json.loads(v)
+            return orjson.loads(v)
         except Exception:
             return {"raw": v}
     try:
-        json.dumps(v)
+        orjson.dumps(v)
         return v
     except Exception:
         return {"raw": str(v)}
 
+@st.cache_data(ttl=PREVIEW_SECONDS - 60, show_spinner=False)
+def get_presigned_url_cached(path: str, seconds: int = PREVIEW_SECONDS) -> str | None:
+    """Presigned URL for one staged file, memoized while the URL is still valid."""
+    sql = f"SELECT GET_PRESIGNED_URL('@{DOCS_STAGE}', ?, ?) AS URL"
+    return sql_scalar(sql, params=[path, seconds])
+
+@st.cache_data(ttl=PREVIEW_SECONDS - 60, show_spinner=False)
+def get_presigned_urls(paths: tuple[str, ...], seconds: int = PREVIEW_SECONDS) -> dict[str, str]:
+    """Presigned URLs for many staged files in a single round trip ({path: url})."""
+    if not paths:
+        return {}
+    values = ",".join(["(?)"] * len(paths))
+    sql = f"""
+        SELECT column1 AS PATH, GET_PRESIGNED_URL('@{DOCS_STAGE}', column1, ?) AS URL
+        FROM (VALUES {values})
+    """
+    rows = session.sql(sql, params=[seconds, *paths]).collect()
+    return {r["PATH"]: r["URL"] for r in rows}
+
+@st.cache_resource(show_spinner=False)
+def _presign_failures() -> dict[str, float]:
+    """path -> time of its last presign failure, shared across reruns and sessions."""
+    return {}
+
+def _presign_failed_recently(path: str) -> bool:
+    failed_at = _presign_failures().get(path)
+    return failed_at is not None and time.monotonic() - failed_at < PRESIGN_RETRY_SECONDS
+
 def get_presigned_url(path: str, seconds: int = PREVIEW_SECONDS) -> str | None:
     """Generate a presigned URL for a file stored in a stage."""
+    if _presign_failed_recently(path):
+        return None
     try:
-        sql = f"SELECT GET_PRESIGNED_URL('@{DOCS_STAGE}', ?, ?) AS URL"
-        url = sql_scalar(sql, params=[path, seconds])
-        return url
+        return get_presigned_url_cached(path, seconds)
     except Exception as e:
+        _presign_failures()[path] = time.monotonic()
         st.warning(f"Could not create presigned URL for '{path}': {e}")
         return None
 
+def presigned_urls(paths, seconds: int = PREVIEW_SECONDS) -> dict[str, str]:
+    """Presigned URLs for the paths that haven't failed recently ({path: url}).
+    A failed batch returns {}: get_presigned_url() then tries (and records) paths one by one."""
+    todo = tuple(p for p in paths if not _presign_failed_recently(p))
+    try:
+        return get_presigned_urls(todo, seconds)
+    except Exception:
+        return {}
+
+# ---------------------------- CACHED LOADERS --------------------
+@st.cache_data(ttl=600, show_spinner=False)
+def load_tables(db: str, schema: str) -> pd.DataFrame:
+    """Base tables in db.schema with row count and storage size."""
+    tables_sql = f"""
+      WITH m AS (
+        SELECT table_schema, table_name, active_bytes
+        FROM {db}.INFORMATION_SCHEMA.TABLE_STORAGE_METRICS
+        WHERE table_schema = ?
+      )
+      SELECT t.table_schema, t.table_name, t.row_count,
+             COALESCE(m.active_bytes,0)/1048576 AS size_mb,
+             t.created
+      FROM {db}.INFORMATION_SCHEMA.TABLES t
+      LEFT JOIN m USING (table_schema, table_name)
+      WHERE t.table_schema = ? AND t.table_type = 'BASE TABLE'
+      ORDER BY size_mb DESC, t.table_name
+    """
+    return sql_to_df_streaming(tables_sql, params=[schema, schema])
+
+@st.cache_data(ttl=120, show_spinner=False)
+def load_preview(db: str, schema: str, tbl: str) -> pd.DataFrame:
+    """First PREVIEW_LIMIT rows of db.schema.tbl, with the table name bound via IDENTIFIER(?)."""
+    sql = "SELECT * FROM IDENTIFIER(?) LIMIT " + str(int(PREVIEW_LIMIT))
+    return sql_to_df(sql, params=[f"{db}.{schema}.{tbl}"])
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_filter_options(db: str, schema: str) -> tuple[list[str], dict[str, tuple[str, ...]]]:
+    """Distinct PERSON values and lower-cased DOC_TYPE values in RAW_DOCS, in one query.
+    Each doc type maps to the spellings stored for it (for the exact-match search filter)."""
+    rows = session.sql(f"""
+        SELECT ARRAY_AGG(DISTINCT PERSON) WITHIN GROUP (ORDER BY PERSON) AS P,
+               ARRAY_AGG(DISTINCT DOC_TYPE) WITHIN GROUP (ORDER BY DOC_TYPE) AS D
+        FROM {db}.{schema}.RAW_DOCS
+        WHERE PERSON IS NOT NULL OR DOC_TYPE IS NOT NULL
+    """).collect()
+    if not rows:
+        return [], {}
+    persons = orjson.loads(rows[0]["P"] or "[]")
+    doctypes: dict[str, tuple[str, ...]] = {}
+    for d in orjson.loads(rows[0]["D"] or "[]"):
+        doctypes[d.lower()] = doctypes.get(d.lower(), ()) + (d,)
+    return persons, dict(sorted(doctypes.items()))
+
 # ---------------------------- SEARCH HELPERS --------------------
-def _extract_hit(hit: dict) -> dict:
+DOC_COLUMNS = ["DOC_ID","FILENAME","RELATIVE_PATH","PERSON","DOC_TYPE","DOC_DATE"]
+SCORE_COLUMNS = ["score_sem","score_text","score_rerank"]
+HIT_COLUMNS = DOC_COLUMNS + SCORE_COLUMNS
+HIT_DTYPES = {**{c: "string" for c in DOC_COLUMNS}, **{c: "float64" for c in SCORE_COLUMNS}}
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def _extract_hit(hit: dict) -> tuple:
+    """Field values of one search hit, in HIT_COLUMNS order."""
     row = hit.get("row") or hit or {}
     scores = hit.get("@scores") or hit.get("scores") or {}
-    return {
-        "DOC_ID":        row.get("DOC_ID"),
-        "FILENAME":      row.get("FILENAME"),
-        "RELATIVE_PATH": row.get("RELATIVE_PATH"),
-        "PERSON":        row.get("PERSON"),
-        "DOC_TYPE":      row.get("DOC_TYPE"),
-        "DOC_DATE":      row.get("DOC_DATE"),
-        "score_sem":     scores.get("cosine_similarity"),
-        "score_text":    scores.get("text_match"),
-    }
+    return (
+        row.get("DOC_ID"),
+        row.get("FILENAME"),
+        row.get("RELATIVE_PATH"),
+        row.get("PERSON"),
+        row.get("DOC_TYPE"),
+        row.get("DOC_DATE"),
+        scores.get("cosine_similarity"),
+        scores.get("text_match"),
+        scores.get("reranker_score"),
+    )
 
-def run_search(query: str, limit: int, service_name: str) -> list[dict]:
-    """Call SEARCH_PREVIEW with a safe column list."""
-    payload = {
-        "query": query,
-        "limit": int(limit),
-        "columns": ["DOC_ID","FILENAME","RELATIVE_PATH","PERSON","DOC_TYPE","DOC_DATE"]
-    }
-    sql = "SELECT SNOWFLAKE.CORTEX.SEARCH_PREVIEW(?, ?) AS RESULT"
-    r = session.sql(sql, params=[service_name, json.dumps(payload)]).collect()
-    if not r:
-        return []
-    raw = r[0]["RESULT"]
-    data = json.loads(raw) if isinstance(raw, str) else raw
-    results = (data or {}).get("results") or []
-    return [_extract_hit(h) for h in results]
-
-def filter_hits_locally(rows, person=None, doc_type=None, d_from=None, d_to=None):
-    from datetime import date
-    def to_date(s):
-        if not s: return None
-        try: return date.fromisoformat(str(s)[:10])
-        except: return None
-
-    out = []
-    for r in rows:
-        if person and (r.get("PERSON") or "").lower() != person.lower():
-            continue
-        if doc_type and (r.get("DOC_TYPE") or "").lower() != doc_type.lower():
+def _hits_frame(hits) -> pd.DataFrame:
+    """Search hits as a column-wise DataFrame with HIT_DTYPES, one row per DOC_ID
+    (first occurrence wins, keeping the best of each score)."""
+    data = {c: [] for c in HIT_COLUMNS}
+    seen: dict[str, int] = {}
+    for hit in hits:
+        values = _extract_hit(hit)
+        doc_id = values[0]
+        i = seen.get(doc_id) if doc_id is not None else None
+        if i is None:
+            if doc_id is not None:
+                seen[doc_id] = len(data["DOC_ID"])
+            for c, v in zip(HIT_COLUMNS, values):
+                data[c].append(v)
             continue
-        if d_from or d_to:
-            dd = to_date(r.get("DOC_DATE"))
-            if d_from and (not dd or dd < d_from): continue
-            if d_to   and (not dd or dd > d_to):   continue
-        out.append(r)
-    return out
+        for c, v in zip(SCORE_COLUMNS, values[len(DOC_COLUMNS):]):
+            col = data[c]
+            if v is not None and (col[i] is None or v > col[i]):
+                col[i] = v
+    return pd.DataFrame(data, columns=HIT_COLUMNS).astype(HIT_DTYPES)
+
+def _as_tuple(doc_type) -> tuple[str, ...]:
+    """A doc type filter value: one spelling or a tuple of stored spellings."""
+    return (doc_type,) if isinstance(doc_type, str) else tuple(doc_type)
+
+def _search_filter(person=None, doc_type=None, d_from=None, d_to=None) -> dict | None:
+    """Cortex Search filter object for the optional predicates (None when none are set)."""
+    clauses = []
+    if person:
+        clauses.append({"@eq": {"PERSON": person}})
+    if doc_type:
+        spellings = [{"@eq": {"DOC_TYPE": d}} for d in _as_tuple(doc_type)]
+        clauses.append(spellings[0] if len(spellings) == 1 else {"@or": spellings})
+    if d_from:
+        clauses.append({"@gte": {"DOC_DATE": d_from.isoformat()}})
+    if d_to:
+        clauses.append({"@lte": {"DOC_DATE": d_to.isoformat()}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"@and": clauses}
+
+def _search_preview(queries: list[str], limit: int, service_name: str, filt: dict | None = None) -> pd.DataFrame:
+    """Call SEARCH_PREVIEW with a safe column list; several queries go out in one statement."""
+    params = []
+    for query in queries:
+        payload = {
+            "query": query,
+            "limit": int(limit),
+            "columns": DOC_COLUMNS,
+        }
+        if filt:
+            payload["filter"] = filt
+        params += [service_name, orjson.dumps(payload).decode()]
+    sql = "\nUNION ALL\n".join(
+        f"SELECT {i} AS I, SNOWFLAKE.CORTEX.SEARCH_PREVIEW(?, ?) AS RESULT" for i in range(len(queries))
+    )
+    if len(queries) > 1:
+        sql += "\nORDER BY I"
+    hits = []
+    for r in session.sql(sql, params=params).collect():
+        raw = r["RESULT"]
+        data = orjson.loads(raw) if isinstance(raw, str) else raw
+        hits += (data or {}).get("results") or []
+    return _hits_frame(hits)
+
+def _is_filter_error(e: Exception) -> bool:
+    """True if SEARCH_PREVIEW failed because of the filter (e.g. column not an ATTRIBUTE)."""
+    msg = str(e).lower()
+    return "filter" in msg or "attribute" in msg
+
+def run_search(queries: list[str], limit: int, service_name: str,
+               person=None, doc_type=None, d_from=None, d_to=None) -> pd.DataFrame:
+    """Search with the optional filters evaluated by the service, so the top-K is all eligible hits."""
+    filt = _search_filter(person, doc_type, d_from, d_to)
+    if filt is None:
+        return _search_preview(queries, limit, service_name)
+    try:
+        return _search_preview(queries, limit, service_name, filt)
+    except SnowparkSQLException as e:
+        # Services built without these ATTRIBUTES reject the filter: fall back to local filtering.
+        if not _is_filter_error(e):
+            raise
+        hits = _search_preview(queries, limit, service_name)
+        return filter_hits_locally(hits, person=person, doc_type=doc_type, d_from=d_from, d_to=d_to)
+
+@st.cache_data(ttl=300, max_entries=128, show_spinner=False)
+def run_search_cached(queries: tuple[str, ...], limit: int, service_name: str, person=None,
+                      doc_type: tuple[str, ...] | None = None,
+                      d_from: str | None = None, d_to: str | None = None) -> pd.DataFrame:
+    """run_search memoized per (queries, limit, service, filters); dates are ISO strings."""
+    return run_search(
+        list(queries), limit, service_name, person=person, doc_type=doc_type,
+        d_from=dt.date.fromisoformat(d_from) if d_from else None,
+        d_to=dt.date.fromisoformat(d_to) if d_to else None,
+    )
+
+def filter_hits_locally(df: pd.DataFrame, person=None, doc_type=None, d_from=None, d_to=None) -> pd.DataFrame:
+    """Apply the optional filters to the hits (string columns, see HIT_DTYPES) as one vectorized mask."""
+    mask = np.ones(len(df), dtype=bool)
+    if person:
+        mask &= df["PERSON"].str.lower().eq(person.lower()).fillna(False).to_numpy(dtype=bool)
+    if doc_type:
+        wanted = {d.lower() for d in _as_tuple(doc_type)}
+        mask &= df["DOC_TYPE"].str.lower().isin(wanted).fillna(False).to_numpy(dtype=bool)
+    if d_from or d_to:
+        dd = pd.to_datetime(df["DOC_DATE"].str[:10], errors="coerce")
+        if d_from:
+            mask &= (dd.notna() & (dd >= pd.Timestamp(d_from))).to_numpy(dtype=bool)
+        if d_to:
+            mask &= (dd.notna() & (dd <= pd.Timestamp(d_to))).to_numpy(dtype=bool)
+    return df[mask]
+
+def _lexical_overlap(query_tokens: Counter, text: str) -> float:
+    """Multiset Jaccard ratio between the query tokens and the tokens of `text`."""
+    doc_tokens = Counter(_TOKEN_RE.findall(text.lower()))
+    union = sum((query_tokens | doc_tokens).values())
+    return sum((query_tokens & doc_tokens).values()) / union if union else 0.0
+
+def rerank_hits(df: pd.DataFrame, queries: list[str], alpha: float = 0.5) -> pd.DataFrame:
+    """Add a combined `score` and sort by it. One rule for the whole frame, so scores stay
+    comparable: the service's reranker score if it returned any; else the alpha-weighted
+    mean of the semantic and text-match scores present on each hit; else lexical overlap
+    of the query with FILENAME + RELATIVE_PATH."""
+    sem    = pd.to_numeric(df["score_sem"], errors="coerce")
+    txt    = pd.to_numeric(df["score_text"], errors="coerce")
+    rerank = pd.to_numeric(df["score_rerank"], errors="coerce")
+    if rerank.notna().any():
+        score = rerank
+    elif sem.notna().any() or txt.notna().any():
+        weight = alpha * sem.notna() + (1 - alpha) * txt.notna()
+        score = (alpha * sem.fillna(0) + (1 - alpha) * txt.fillna(0)) / weight.where(weight > 0)
+    else:
+        query_tokens = Counter(_TOKEN_RE.findall(" ".join(queries).lower()))
+        text = df["FILENAME"].fillna("").astype(str) + " " + df["RELATIVE_PATH"].fillna("").astype(str)
+        score = text.map(lambda t: _lexical_overlap(query_tokens, t)).astype("float64")
+    return df.assign(score=score).sort_values("score", ascending=False, kind="stable",
+                                              na_position="last", ignore_index=True)
 
 # ---------------------------- AGENT HELPER ----------------------
-def agent_answer(prompt: str) -> str:
-    """Calls your FA_DOCS_AGENT via the Cortex function and returns text."""
+# Lists of turns in an EXECUTE_AGENT response, scanned from the end for the answer
+_AGENT_TURN_LISTS = ("messages", "output")
+
+def _agent_content(data):
+    """Answer content (text, or a list of content items) from an agent response, or None
+    if it has no known shape: message.content, else the last non-empty content in
+    messages/output."""
+    if not isinstance(data, dict):
+        return None
+    msg = data.get("message")
+    if isinstance(msg, dict) and isinstance(msg.get("content"), (str, list)) and msg["content"]:
+        return msg["content"]
+    for key in _AGENT_TURN_LISTS:
+        turns = data.get(key)
+        if not isinstance(turns, list):
+            continue
+        for m in reversed(turns):
+            if isinstance(m, dict) and isinstance(m.get("content"), (str, list)) and m["content"]:
+                return m["content"]
+    return None
+
+def _execute_agent(prompt: str, session_id: str | None = None):
+    """Run FA_DOCS_AGENT via the Cortex function; returns the answer content
+    (text or content items) or, when none is found, the decoded response."""
+    sql = "SELECT SNOWFLAKE.CORTEX.EXECUTE_AGENT(?, OBJECT_CONSTRUCT('input', ?, 'session_id', ?)) AS R"
+    res = session.sql(sql, params=[AGENT_NAME, prompt, session_id]).collect()
+    if not res:
+        return "Agent returned no result."
+    obj = res[0]["R"]
+    data = orjson.loads(obj) if isinstance(obj, str) else obj
+    return _agent_content(data) or data
+
+def _agent_table(result_set: dict) -> pd.DataFrame:
+    """DataFrame from an agent table result ({"data": rows, "resultSetMetaData": {"rowType": cols}})."""
+    cols = [c.get("name") for c in (result_set.get("resultSetMetaData") or {}).get("rowType") or []]
+    return pd.DataFrame(result_set.get("data") or [], columns=cols or None)
+
+def _agent_parts(content) -> list[tuple]:
+    """Answer parts from the content list of the agent's final `response` event."""
+    parts = []
+    for item in content or []:
+        if not isinstance(item, dict):
+            continue
+        kind = item.get("type")
+        if kind == "text" and item.get("text"):
+            parts.append(("text", item["text"]))
+        elif kind == "table":
+            parts.append(("table", _agent_table((item.get("table") or {}).get("result_set") or {})))
+        elif kind == "chart":
+            parts.append(("chart", orjson.loads((item.get("chart") or {}).get("chart_spec") or "{}")))
+    return parts
+
+def show_agent_part(kind: str, value, target=st):
+    """Render one answer part ("text", "table", "chart", "error" or "json") into `target`."""
+    if kind == "text":
+        target.markdown(value)
+    elif kind == "table":
+        target.dataframe(value, use_container_width=True)
+    elif kind == "chart":
+        target.vega_lite_chart(value, use_container_width=True)
+    elif kind == "error":
+        target.error(value)
+    else:
+        target.json(value)
+
+def show_agent_answer(parts):
+    """Render an answer: its list of (kind, value) parts, in order."""
+    for kind, value in parts:
+        show_agent_part(kind, value)
+
+def _iter_sse(resp):
+    """(event, data) pairs from a text/event-stream response."""
+    event, data = None, []
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = None, []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].lstrip())
+    if data:
+        yield event, "\n".join(data)
+
+def _rest_headers(conn, stream: bool = False) -> dict:
+    return {
+        "Authorization": f'Snowflake Token="{conn.rest.token}"',
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream" if stream else "application/json",
+    }
+
+def _agent_thread(conn, thread: dict) -> None:
+    """Create the server-side conversation thread on first use (thread_id, parent_message_id)."""
+    if thread.get("thread_id") is not None:
+        return
+    resp = requests.post(
+        f"https://{conn.host}/api/v2/cortex/threads",
+        headers=_rest_headers(conn),
+        data=orjson.dumps({"origin_application": "openflow_fa"}),
+        timeout=(10, 30),
+    )
+    resp.raise_for_status()
+    body = resp.json()
+    thread["thread_id"] = body.get("thread_id") if isinstance(body, dict) else body
+    thread["parent_message_id"] = 0
+
+@st.cache_resource(show_spinner=False)
+def _agent_rest_failures() -> dict[str, float]:
+    """"rest" -> time the agent REST API last failed, shared across reruns and sessions."""
+    return {}
+
+def _agent_rest_failed_recently() -> bool:
+    failed_at = _agent_rest_failures().get("rest")
+    return failed_at is not None and time.monotonic() - failed_at < AGENT_REST_RETRY_SECONDS
+
+def _agent_fallback(prompt: str, session_id: str | None):
+    """The blocking agent call (Cortex function) as answer parts.
+    Turns sharing a session_id continue the same agent conversation."""
+    try:
+        ans = _execute_agent(prompt, session_id)
+    except Exception as e:
+        yield "error", f"Agent call failed: {e}"
+        return
+    if isinstance(ans, str):
+        yield "text", ans
+    elif isinstance(ans, list):
+        yield from _agent_parts(ans) or [("json", ans)]
+    else:
+        yield "json", ans
+
+def agent_stream(prompt: str, session_id: str | None = None, thread: dict | None = None):
+    """Yields the agent's answer as (kind, value) parts as they arrive (agent REST API, SSE):
+    text deltas, tables and charts. Turns go to the server-side `thread` (updated in place),
+    so earlier turns are never re-sent. Falls back to the blocking call where streaming is
+    unavailable, and keeps using it for AGENT_REST_RETRY_SECONDS after a REST failure."""
+    thread = {} if thread is None else thread
+    if _agent_rest_failed_recently():
+        yield from _agent_fallback(prompt, session_id)
+        return
+    try:
+        conn = session.connection
+        _agent_thread(conn, thread)
+        resp = requests.post(
+            f"https://{conn.host}/api/v2/databases/{DB}/schemas/{SCHEMA}/agents/{AGENT_NAME}:run",
+            headers=_rest_headers(conn, stream=True),
+            data=orjson.dumps({
+                "thread_id": thread["thread_id"],
+                "parent_message_id": thread["parent_message_id"],
+                "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                "stream": True,
+            }),
+            stream=True,
+            timeout=(10, 300),
+        )
+        resp.raise_for_status()
+    except Exception:
+        # e.g. no REST token inside Snowflake: skip REST on the next turns too
+        _agent_rest_failures()["rest"] = time.monotonic()
+        yield from _agent_fallback(prompt, session_id)
+        return
+    shown, final, reply_id = False, None, None
     try:
-        sql = "SELECT SNOWFLAKE.CORTEX.EXECUTE_AGENT(?, OBJECT_CONSTRUCT('input', ?)) AS R"
-        res = session.sql(sql, params=["FA_DOCS_AGENT", prompt]).collect()
-        if not res:
-            return "Agent returned no result."
-        obj = res[0]["R"]
-        data = json.loads(obj) if isinstance(obj, str) else obj
-        if isinstance(data, dict):
-            msg = data.get("message")
-            if isinstance(msg, dict) and msg.get("content"):
-                return msg["content"]
-            msgs = data.get("messages") or data.get("output") or []
-            if isinstance(msgs, list):
-                for m in reversed(msgs):
-                    if isinstance(m, dict) and m.get("content"):
-                        return m["content"]
-        return json.dumps(data, indent=2)
+        with resp:
+            for event, data in _iter_sse(resp):
+                if event == "response.text.delta":
+                    text = orjson.loads(data).get("text", "")
+                    if text:
+                        shown = True
+                        yield "text", text
+                elif event == "response.table":
+                    shown = True
+                    yield "table", _agent_table(orjson.loads(data).get("result_set") or {})
+                elif event == "response.chart":
+                    shown = True
+                    yield "chart", orjson.loads(orjson.loads(data).get("chart_spec") or "{}")
+                elif event == "metadata":
+                    meta = orjson.loads(data)
+                    if meta.get("role") == "assistant":
+                        reply_id = meta.get("message_id")
+                elif event == "response":
+                    final = orjson.loads(data)
+                elif event == "error":
+                    yield "error", f"Agent call failed: {orjson.loads(data).get('message', data)}"
+                    return
+        if not shown and final is not None:
+            # Nothing streamed: show the final response instead of an empty answer
+            parts = _agent_parts(final.get("content"))
+            shown = bool(parts)
+            yield from parts or [("json", final)]
     except Exception as e:
-        return f"Agent call failed: {e}"
+        # Broken stream or unexpected payload: report it and leave the thread as it was
+        yield "error", f"Agent call failed: {e}"
+        return
+    if final is None and not shown:
+        yield from _agent_fallback(prompt, session_id)
+        return
+    # Only answered turns extend the thread; failed or empty ones are left out of the context
+    if shown and reply_id is not None:
+        thread["parent_message_id"] = reply_id
+
+# ------------------------- STARTUP QUERIES ----------------------
+# Independent and I/O bound: run them concurrently on the shared session
+with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx,
+                        initargs=(None, get_script_run_ctx())) as ex:
+    f_tables  = ex.submit(load_tables, DB, SCHEMA)
+    f_filters = ex.submit(load_filter_options, DB, SCHEMA)
+    tables_df = f_tables.result()
+    persons, doctypes = f_filters.result()
 
 # ----------------------------- TABS -----------------------------
 tab1, tab2, tab3 = st.tabs(["🗃️ Data Explorer", "📄 Docs Search", "💬 Chat with Agent"])
@@ -191,17 +602,6 @@ tab1, tab2, tab3 = st.tabs(["🗃️ Data Explorer", "📄 Docs Search", "💬 C
 # =========================== TAB 1 ==============================
 with tab1:
     st.subheader(f"Tables in {DB}.{SCHEMA}")
-    tables_sql = f"""
-      SELECT t.table_schema, t.table_name, t.row_count,
-             COALESCE(m.active_bytes,0)/POWER(1024,2) AS size_mb,
-             t.created
-      FROM {DB}.INFORMATION_SCHEMA.TABLES t
-      LEFT JOIN {DB}.INFORMATION_SCHEMA.TABLE_STORAGE_METRICS m
-        ON m.table_schema = t.table_schema AND m.table_name = t.table_name
-      WHERE t.table_schema = '{SCHEMA}' AND t.table_type = 'BASE TABLE'
-      ORDER BY size_mb DESC, t.table_name;
-    """
-    tables_df = sql_to_df(tables_sql)
     st.dataframe(tables_df, use_container_width=True, height=280)
 
     st.divider()
@@ -213,7 +613,7 @@ with tab1:
         key="tbl_pick",
     )
     if tbl:
-        preview_df = sql_to_df(f"SELECT * FROM {DB}.{SCHEMA}.{tbl} LIMIT {PREVIEW_LIMIT}")
+        preview_df = load_preview(DB, SCHEMA, tbl)
         st.caption(f"Showing up to {PREVIEW_LIMIT} rows from {DB}.{SCHEMA}.{tbl}")
         st.dataframe(preview_df, use_container_width=True)
 
@@ -222,24 +622,19 @@ with tab2:
     st.subheader("Semantic search over uploaded documents")
 
     with st.container(border=True):
-        q = st.text_input("Query", placeholder="e.g., remote work policy, onboarding, invoice total …", key="q_text")
+        q = st.text_input(
+            "Query",
+            placeholder="e.g., remote work policy, onboarding, invoice total …",
+            help="Separate several queries with ';' to run them together.",
+            key="q_text",
+        )
 
         colA, colB, colC, colD = st.columns([1, 1, 1, 1])
 
-        persons = session.sql(f"""
-            SELECT DISTINCT PERSON FROM {DB}.{SCHEMA}.RAW_DOCS
-            WHERE PERSON IS NOT NULL ORDER BY 1
-        """).to_pandas()["PERSON"].tolist()
-        persons = ["(any)"] + persons
-
-        doctypes = session.sql(f"""
-            SELECT DISTINCT LOWER(DOC_TYPE) AS DOC_TYPE FROM {DB}.{SCHEMA}.RAW_DOCS
-            WHERE DOC_TYPE IS NOT NULL ORDER BY 1
-        """).to_pandas()["DOC_TYPE"].tolist()
-        doctypes = ["(any)"] + doctypes
+        person_opts = ["(any)"] + persons
 
-        person_sel = colA.selectbox("Person (optional)", persons, index=0, key="person_sel")
-        dtype_sel  = colB.selectbox("Doc type (optional)", doctypes, index=0, key="dtype_sel")
+        person_sel = colA.selectbox("Person (optional)", person_opts, index=0, key="person_sel")
+        dtype_sel  = colB.selectbox("Doc type (optional)", ["(any)"] + list(doctypes), index=0, key="dtype_sel")
         d_from     = colC.date_input("From date", value=None, key="d_from")
         d_to       = colD.date_input("To date",   value=None, key="d_to")
 
@@ -248,33 +643,49 @@ with tab2:
     btn = st.button("Search", type="primary")
 
     if btn:
-        if not q or not q.strip():
+        if not q or not q.replace(";", "").strip():
             st.warning("Enter a search query first.")
         else:
             p = None if person_sel in (None, "", "(any)") else person_sel
-            t = None if dtype_sel  in (None, "", "(any)") else dtype_sel
+            t = None if dtype_sel  in (None, "", "(any)") else doctypes.get(dtype_sel, (dtype_sel,))
             d1 = d_from if isinstance(d_from, dt.date) else None
             d2 = d_to   if isinstance(d_to,   dt.date) else None
 
             try:
-                rows = run_search(q.strip(), int(limit), SEARCH_SERVICE)
-                rows = filter_hits_locally(rows, person=p, doc_type=t, d_from=d1, d_to=d2)
-                hits_df = pd.DataFrame(rows)
+                queries = tuple(part.strip() for part in q.split(";") if part.strip())
+                hits_df = run_search_cached(
+                    queries, int(limit), SEARCH_SERVICE, p, t,
+                    d1.isoformat() if d1 else None, d2.isoformat() if d2 else None,
+                )
+                # Each batched query returns up to `limit` hits: cap the merged list
+                hits_df = rerank_hits(hits_df, list(queries)).head(int(limit))
             except Exception as e:
                 st.error(f"Search failed: {e}")
                 hits_df = pd.DataFrame()
+            # Keep the hits so widget interactions below don't need a new search
+            st.session_state["last_hits"] = hits_df
 
-            if hits_df.empty:
-                st.info("No matches.")
-            else:
-                cols = ["DOC_ID","FILENAME","RELATIVE_PATH","PERSON","DOC_TYPE","DOC_DATE","score_sem","score_text"]
-                hits_df = hits_df[[c for c in cols if c in hits_df.columns]]
-                st.dataframe(hits_df, use_container_width=True, height=350)
+    hits_df = st.session_state.get("last_hits")
+    if hits_df is not None:
+        if hits_df.empty:
+            st.info("No matches.")
+        else:
+            hits_df = hits_df[DOC_COLUMNS + ["score"] + SCORE_COLUMNS]
+            st.dataframe(hits_df, use_container_width=True, height=350)
+
+            paths = hits_df.get("RELATIVE_PATH")
+            uniq = paths.dropna().unique() if paths is not None else []
+            if len(uniq):
+                urls = presigned_urls(uniq)
+                sel = st.selectbox("Pick a path to preview", uniq, key="preview_path")
+                url = urls.get(sel) or get_presigned_url(sel)
+                if url:
+                    st.link_button(f"Open {sel}", url)
 
 # =========================== TAB 3 ==============================
 with tab3:
     st.subheader("Chat with Agent")
-    st.caption("Using agent: **FA_DOCS_AGENT**. Tip: ask for tables, e.g., “count by doc_type last 12 months”.")
+    st.caption(f"Using agent: **{AGENT_NAME}**. Tip: ask for tables, e.g., “count by doc_type last 12 months”.")
 
     user_q = st.text_area(
         "Your question",
@@ -284,10 +695,35 @@ with tab3:
 
     ask = st.button("Ask Agent", type="primary", key="ask_agent_btn")
 
+    if "chat_id" not in st.session_state:
+        st.session_state.chat_id = str(uuid.uuid4())
+    if "chat_history" not in st.session_state:
+        st.session_state.chat_history = []
+    if "chat_thread" not in st.session_state:
+        st.session_state.chat_thread = {}
+
+    for past_q, past_ans in st.session_state.chat_history:
+        with st.chat_message("user"):
+            st.markdown(past_q)
+        with st.chat_message("assistant"):
+            show_agent_answer(past_ans)
+
     if ask:
         if not user_q or not user_q.strip():
             st.warning("Please enter a question.")
         else:
-            with st.spinner("Thinking…"):
-                ans = agent_answer(user_q.strip())
-            st.write(ans)
+            question = user_q.strip()
+            with st.chat_message("user"):
+                st.markdown(question)
+            with st.chat_message("assistant"):
+                parts, slot = [], None
+                with st.spinner("Thinking…"):
+                    for kind, value in agent_stream(question, st.session_state.chat_id,
+                                                    st.session_state.chat_thread):
+                        if kind == "text" and parts and parts[-1][0] == "text":
+                            parts[-1] = ("text", parts[-1][1] + value)
+                        else:
+                            parts.append((kind, value))
+                            slot = st.empty()
+                        show_agent_part(*parts[-1], target=slot)
+            st.session_state.chat_history.append((question, parts))